@@ -1,27 +1,57 @@
 import os
-import json
+import io
+import orjson
+import asyncio
 import random
-import shutil
-import re
+import hashlib
+import time
+import logging
 import numpy as np
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from cachetools import TTLCache
 
 # Audio & AI libs
-import whisper
 import ollama
+import ctranslate2
+import faster_whisper
+from faster_whisper import WhisperModel, BatchedInferencePipeline
 import librosa
 from pydub import AudioSegment
 
 # Web Server libs
+import anyio.to_thread
 import uvicorn
 from fastapi import FastAPI, HTTPException, Query, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 # Database (Optional)
 import firebase_admin
 from firebase_admin import credentials, firestore
 
-app = FastAPI(title="EquiGrader AI API", version="2.2")
+# Logging (set EQUIGRADER_LOG_LEVEL=DEBUG to see raw AI responses)
+logging.basicConfig(
+    level=os.environ.get("EQUIGRADER_LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger("equigrader")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Starlette's worker pool defaults to 40 threads; blocking work is offloaded
+    # there, so don't let it become the concurrency ceiling.
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = int(os.environ.get("EQUIGRADER_THREADS", "128"))
+
+    # Ollama self-check runs in the background so a slow model load doesn't delay startup
+    run_in_background(check_ollama_parallelism())
+    yield
+
+app = FastAPI(title="EquiGrader AI API", version="2.2", lifespan=lifespan)
 
 # 1. Setup CORS (Allows frontend to talk to us)
 app.add_middleware(
@@ -39,28 +69,106 @@ try:
         cred = credentials.Certificate("serviceAccountKey.json")
         firebase_admin.initialize_app(cred)
         db = firestore.client()
-        print("Firebase connected successfully.")
+        logger.info("Firebase connected successfully.")
     else:
-        print("Note: serviceAccountKey.json missing. Running without database.")
+        logger.info("Note: serviceAccountKey.json missing. Running without database.")
 except Exception as e:
-    print(f"Database init failed: {e}")
+    logger.error("Database init failed: %s", e)
 
 # 3. Load Data
 questions_db = []
 try:
-    with open("questions.json", "r") as f:
-        questions_db = json.load(f)
-    print(f"Loaded {len(questions_db)} questions.")
+    with open("questions.json", "rb") as f:
+        questions_db = orjson.loads(f.read())
+    logger.info("Loaded %d questions.", len(questions_db))
 except Exception as e:
-    print("Error loading questions:", e)
+    logger.error("Error loading questions: %s", e)
+
+# id -> question, so lookups don't scan the whole bank
+question_index = {q["id"]: q for q in questions_db}
+
+# lowercased topic -> questions, so /get_question doesn't re-lower every entry
+topic_index = defaultdict(list)
+for q in questions_db:
+    topic_index[q["topic"].lower()].append(q)
 
 # 4. Load AI Models
 whisper_model = None
 try:
-    whisper_model = whisper.load_model("base")
-    print("Whisper speech engine ready.")
-except:
-    print("Warning: Whisper failed to load.")
+    # CTranslate2 int8 weights (fp16 activations on GPU); the batched pipeline
+    # pushes several 30s windows through the encoder in one pass.
+    if ctranslate2.get_cuda_device_count() > 0:
+        device, compute_type = "cuda", "int8_float16"
+    else:
+        device, compute_type = "cpu", "int8"
+    whisper_model = BatchedInferencePipeline(
+        model=WhisperModel("base", device=device, compute_type=compute_type)
+    )
+    logger.info("Whisper speech engine ready (%s, %s).", device, compute_type)
+except Exception:
+    logger.exception("Whisper failed to load.")
+
+# Ollama server tuning. These are read by `ollama serve`, not by us, so they
+# only take effect if the server is started from this environment; we report
+# them and verify the behaviour with a self-check at startup.
+os.environ.setdefault("OLLAMA_NUM_PARALLEL", "4")
+os.environ.setdefault("OLLAMA_KEEP_ALIVE", "30m")
+os.environ.setdefault("OLLAMA_MAX_LOADED_MODELS", "1")
+logger.info(
+    "Ollama settings: OLLAMA_NUM_PARALLEL=%s, OLLAMA_KEEP_ALIVE=%s, OLLAMA_MAX_LOADED_MODELS=%s",
+    os.environ["OLLAMA_NUM_PARALLEL"], os.environ["OLLAMA_KEEP_ALIVE"], os.environ["OLLAMA_MAX_LOADED_MODELS"],
+)
+
+# Async Ollama client (created once, shared by every request).
+# Pair with OLLAMA_NUM_PARALLEL on the Ollama server so calls actually overlap.
+ASYNC_OLLAMA = ollama.AsyncClient(host=os.environ.get("OLLAMA_HOST"))
+
+# Caps in-flight LLM calls at what the Ollama server runs in parallel, so
+# extra requests queue here instead of oversubscribing the model
+# (OLLAMA_NUM_PARALLEL=0 means "auto" on some Ollama versions, so never go below 1)
+llm_slots = asyncio.Semaphore(max(1, int(os.environ["OLLAMA_NUM_PARALLEL"])))
+LLM_TIMEOUT = 60
+
+# Quantized phi3 with the rubric-grading SYSTEM prompt baked in (see Modelfile)
+GRADER_MODEL = "phi3-grader"
+# /chat uses the grader's base weights (the Modelfile's FROM tag), so with
+# OLLAMA_MAX_LOADED_MODELS=1 a chat message doesn't evict the grader
+CHAT_MODEL = "phi3:3.8b-mini-4k-instruct-q4_K_M"
+
+# Exact shape of a grading reply; passed to Ollama as a structured-output schema
+GRADE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "rubric_evaluation": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "point": {"type": "string"},
+                    "met": {"type": "boolean"},
+                    "feedback": {"type": "string"},
+                },
+                "required": ["point", "met", "feedback"],
+            },
+        },
+        "overall_score": {"type": "number"},
+        "final_summary": {"type": "string"},
+    },
+    "required": ["rubric_evaluation", "overall_score", "final_summary"],
+}
+
+# Decoding budget for a grading reply: summary/score overhead plus one
+# rubric_evaluation entry per rubric point
+GRADE_BASE_TOKENS = 160
+GRADE_TOKENS_PER_POINT = 80
+
+# How long Ollama keeps the grader resident between questions (one value for
+# warm-ups and gradings, so neither shortens what the other set)
+GRADER_KEEP_ALIVE = os.environ["OLLAMA_KEEP_ALIVE"]
+
+# Recent grades keyed by (question id, normalised answer hash); catches
+# double-submits and stock answers like "I don't know" without an LLM call
+grade_cache = TTLCache(maxsize=4096, ttl=3600)
 
 # --- Request Models ---
 class AnswerReq(BaseModel):
@@ -73,75 +181,148 @@ class ChatReq(BaseModel):
 # --- Core Functions ---
 
 def find_question(qid):
-    for q in questions_db:
-        if q["id"] == qid:
-            return q
-    return None
+    return question_index.get(qid)
+
+@lru_cache(maxsize=256)
+def questions_for_topic(topic):
+    """All questions whose topic contains `topic` (case-insensitive)."""
+    key = topic.lower()
+    matches = []
+    for name, qs in topic_index.items():
+        if key in name:
+            matches.extend(qs)
+    return tuple(matches)
+
+# Strong refs to fire-and-forget tasks so they aren't garbage collected mid-flight
+background_tasks = set()
+
+def _task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning("Background task failed: %s", task.exception())
+
+async def llm_chat(**kwargs):
+    """ASYNC_OLLAMA.chat, bounded by `llm_slots`; LLM_TIMEOUT covers queueing too."""
+    async def bounded_chat():
+        async with llm_slots:
+            return await ASYNC_OLLAMA.chat(**kwargs)
+
+    return await asyncio.wait_for(bounded_chat(), timeout=LLM_TIMEOUT)
+
+def run_in_background(coro):
+    """Schedules `coro` without awaiting it; failures are logged, not raised."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_task_done)
+
+def ping_grader(keep_alive=GRADER_KEEP_ALIVE, num_predict=1):
+    return ASYNC_OLLAMA.generate(
+        model=GRADER_MODEL,
+        prompt=" ",
+        options={'num_predict': num_predict},
+        keep_alive=keep_alive,
+    )
+
+def warm_up_grader(keep_alive=GRADER_KEEP_ALIVE):
+    """Loads the grader model in the background so it's hot when the answer arrives."""
+    run_in_background(ping_grader(keep_alive))
+
+async def check_ollama_parallelism():
+    """Warns if Ollama runs two concurrent requests one after the other."""
+    try:
+        await ping_grader()  # first call pays the model load
+        start = time.perf_counter()
+        await ping_grader(num_predict=16)
+        single = time.perf_counter() - start
+        start = time.perf_counter()
+        await asyncio.gather(ping_grader(num_predict=16), ping_grader(num_predict=16))
+        pair = time.perf_counter() - start
+    except Exception as e:
+        logger.warning("Ollama self-check skipped: %s", e)
+        return
+
+    if pair > 1.8 * single:
+        logger.warning(
+            "Ollama serialized concurrent requests (%.2fs alone, %.2fs for two). "
+            "Restart it with OLLAMA_NUM_PARALLEL set.", single, pair
+        )
+    else:
+        logger.info("Ollama handles concurrent requests in parallel.")
+
+def decode_audio(audio_bytes):
+    """Decodes uploaded audio into the 16 kHz mono float32 array Whisper expects."""
+    # PyAV decodes in-process: no ffmpeg subprocess, no audioop resampling
+    return faster_whisper.decode_audio(io.BytesIO(audio_bytes), sampling_rate=16000)
 
-def get_transcription(file_path):
-    """Converts audio file to text using Whisper."""
+def get_transcription(audio):
+    """Converts audio (file path or float32 array) to text using Whisper."""
     if not whisper_model:
         return "Error: Model not loaded"
     
-    # We allow CPU usage with fp16=False
-    result = whisper_model.transcribe(file_path, fp16=False)
-    return result["text"]
+    # Silero VAD drops leading/trailing silence before it reaches the encoder
+    segments, _ = whisper_model.transcribe(
+        audio,
+        batch_size=8,
+        vad_filter=True,
+        vad_parameters=dict(min_silence_duration_ms=500),
+    )
+    return " ".join(seg.text.strip() for seg in segments)
 
-# NOTE: We use standard 'def' (not async) for heavy AI tasks 
-# to prevent blocking the server heartbeat.
-def grade_with_llm(qid, user_answer):
+# NOTE: LLM calls are awaited on the shared AsyncClient so concurrent
+# gradings overlap instead of queueing behind each other.
+async def grade_with_llm(qid, user_answer):
     q_data = find_question(qid)
     if not q_data:
         raise HTTPException(status_code=404, detail="Question not found")
+
+    cache_key = (qid, hashlib.sha1(user_answer.strip().lower().encode()).digest())
+    if cache_key in grade_cache:
+        # Copy so callers can add fields without touching the cached entry
+        return dict(grade_cache[cache_key])
     
     # Format the rubric for the AI
+    rubric = q_data.get('scoring_rubric', [])
     rubric_text = ""
-    for idx, item in enumerate(q_data.get('scoring_rubric', [])):
+    for idx, item in enumerate(rubric):
         rubric_text += f"{idx+1}. {item['point']}: {item['expected_answer']}\n"
 
-    # The Logic Prompt (Anti-Bias)
-    system_prompt = f"""
-    You are an impartial technical interviewer. Grade the candidate based on this rubric.
-    
-    Question: "{q_data['question']}"
-    Rubric:
-    {rubric_text}
-    
-    Candidate Answer: "{user_answer}"
-    
-    Grading Rules:
-    1. Score from 0 to 100. (60 is a pass).
-    2. Focus on TECHNICAL CORRECTNESS only. Ignore grammar/accent.
-    3. If they hit the key concepts, score > 75.
-    4. Do not be too harsh on short answers if they are accurate.
-    
-    Return JSON only:
-    {{
-      "rubric_evaluation": [
-        {{ "point": "Point Name", "met": true, "feedback": "note" }}
-      ],
-      "overall_score": 0,
-      "final_summary": "summary here"
-    }}
-    """
+    # The grading rules (Anti-Bias) live in the Modelfile's SYSTEM prompt,
+    # so each call only carries the question-specific part.
+    user_prompt = f"""Question: "{q_data['question']}"
+Rubric:
+{rubric_text}
+Candidate Answer: "{user_answer}"
+"""
 
     try:
-        # Ask Ollama
-        res = ollama.chat(model='phi3', messages=[{'role': 'user', 'content': system_prompt}])
+        # Ask Ollama. The schema constrains decoding to valid JSON of the
+        # right shape, and num_predict caps how long the model can ramble
+        # (sized from the rubric: one feedback entry per point plus a summary)
+        res = await llm_chat(
+            model=GRADER_MODEL,
+            format=GRADE_SCHEMA,
+            messages=[{'role': 'user', 'content': user_prompt}],
+            options={
+                'num_predict': GRADE_BASE_TOKENS + GRADE_TOKENS_PER_POINT * len(rubric),
+                'temperature': 0,
+                'top_p': 1,
+            },
+            keep_alive=GRADER_KEEP_ALIVE,
+        )
         ai_output = res['message']['content']
-        print(f"AI Response: {ai_output}") 
+        logger.debug("AI Response: %s", ai_output)
 
-        # Find JSON in the response
-        match = re.search(r'\{[\s\S]*\}', ai_output)
-        if match:
-            data = json.loads(match.group(0))
-        else:
+        if res.get('done_reason') == 'length':
+            # Hit the token cap mid-JSON; don't report it as a server fault
+            logger.warning("Grading for %s hit the token limit; reply was cut off", qid)
             return {
-                "overall_score": 70, 
-                "final_summary": "AI error: output format invalid", 
-                "rubric_evaluation": []
+                "overall_score": 0,
+                "final_summary": "AI error: the grading response was cut off. Please submit again.",
+                "rubric_evaluation": [],
             }
 
+        data = orjson.loads(ai_output)
+
         # Fix score scaling issues (e.g. 0.8 -> 80)
         score = data.get("overall_score", 0)
         if score <= 1: score = int(score * 100)
@@ -149,56 +330,95 @@ def grade_with_llm(qid, user_answer):
         
         if score > 100: score = 100
         data["overall_score"] = score
-        
-        return data
+
+        grade_cache[cache_key] = data
+        return dict(data)
 
     except Exception as e:
-        print(f"Grading failed: {e}")
+        logger.error("Grading failed: %s", e)
         return {"overall_score": 0, "final_summary": "Server error", "rubric_evaluation": []}
 
 # --- API Routes ---
 
+@app.get("/health")
+def route_health():
+    # Cheap liveness probe for the frontend (instead of fetching /docs)
+    return {"ok": True}
+
 @app.get("/get_question")
 def route_get_question(topic: str = Query(...)):
-    # Filter questions by topic
-    filtered = [q for q in questions_db if topic.lower() in q["topic"].lower()]
+    filtered = questions_for_topic(topic)
     if not filtered:
         raise HTTPException(status_code=404, detail="No questions found")
     return random.choice(filtered)
 
+@app.get("/get_questions")
+def route_get_questions(topic: str = Query(...), n: int = Query(20, ge=1, le=100)):
+    # Several distinct questions in one round trip (for client-side prefetching)
+    filtered = questions_for_topic(topic)
+    if not filtered:
+        raise HTTPException(status_code=404, detail="No questions found")
+    return random.sample(filtered, min(n, len(filtered)))
+
+@app.get("/start_interview")
+async def route_start_interview(topic: str = Query(...)):
+    # Same payload as /get_question, but also loads the grader while the
+    # candidate is still reading the question.
+    question = route_get_question(topic)
+    warm_up_grader()
+    return question
+
 @app.post("/evaluate_answer")
-def route_eval_text(req: AnswerReq):
-    # Runs in threadpool to avoid blocking
-    return grade_with_llm(req.question_id, req.answer_text)
+async def route_eval_text(req: AnswerReq):
+    return await grade_with_llm(req.question_id, req.answer_text)
+
+async def transcribe_bytes(audio_bytes):
+    # Decode in memory (no temp file); decoding and Whisper are CPU-bound,
+    # so keep them off the event loop
+    samples = await run_in_threadpool(decode_audio, audio_bytes)
+    return await run_in_threadpool(get_transcription, samples)
 
 @app.post("/evaluate_audio")
-def route_eval_audio(question_id: str = File(...), audio_file: UploadFile = File(...)):
-    temp_filename = f"temp_{audio_file.filename}"
-    
-    # Save file to disk
-    with open(temp_filename, "wb") as f:
-        shutil.copyfileobj(audio_file.file, f)
-        
-    try:
-        # Optional: Use pydub to check audio length (demonstrating library usage)
-        # audio = AudioSegment.from_file(temp_filename)
-        # print(f"Audio Length: {len(audio)}ms")
-
-        # Process
-        text = get_transcription(temp_filename)
-        result = grade_with_llm(question_id, text)
-        result["transcribed_text"] = text
-        return result
-    finally:
-        # Cleanup
-        if os.path.exists(temp_filename):
-            os.remove(temp_filename)
+async def route_eval_audio(question_id: str = File(...), audio_file: UploadFile = File(...)):
+    # Load phi3 while Whisper works, so grading doesn't pay the model load
+    warm_up_grader()
+    audio_bytes = await audio_file.read()
+
+    text = await transcribe_bytes(audio_bytes)
+    result = await grade_with_llm(question_id, text)
+    result["transcribed_text"] = text
+    return result
+
+@app.post("/evaluate_audio_stream")
+async def route_eval_audio_stream(question_id: str = File(...), audio_file: UploadFile = File(...)):
+    # Same work as /evaluate_audio, sent as NDJSON: a {"delta", "transcribed_text"}
+    # line as soon as Whisper finishes, then a {"result"} line once graded.
+    if not find_question(question_id):
+        raise HTTPException(status_code=404, detail="Question not found")
+    warm_up_grader()
+    # Read now: the upload is closed once the endpoint returns
+    audio_bytes = await audio_file.read()
+
+    async def events():
+        # Headers are already sent once this runs, so failures are reported
+        # as an {"error"} line instead of an HTTP status
+        try:
+            text = await transcribe_bytes(audio_bytes)
+            yield orjson.dumps({"delta": text, "transcribed_text": text}) + b"\n"
+            result = await grade_with_llm(question_id, text)
+            result["transcribed_text"] = text
+            yield orjson.dumps({"result": result}) + b"\n"
+        except Exception as e:
+            logger.error("Audio evaluation failed: %s", e)
+            yield orjson.dumps({"error": "Audio processing failed"}) + b"\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 @app.post("/chat")
-def route_chat(req: ChatReq):
+async def route_chat(req: ChatReq):
     context = "You are EquiGrader AI assistant. Help students with app usage or tech concepts."
     try:
-        res = ollama.chat(model='phi3', messages=[
+        res = await llm_chat(model=CHAT_MODEL, messages=[
             {'role': 'system', 'content': context},
             {'role': 'user', 'content': req.message}
         ])
@@ -1,10 +1,23 @@
+import io
+import json
+import os
+import queue
+import random
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 from streamlit_mic_recorder import mic_recorder
 
 # Config
 API_URL = "http://127.0.0.1:8000"
+# (connect, read) timeout for grading calls; comfortably above the backend's
+# 60s LLM_TIMEOUT, which covers both queueing for a slot and the LLM call
+GRADING_TIMEOUT = (3, 90)
+TOPIC_MAP = {"Electronics (ECE)": "ECE", "Aptitude": "Aptitude"}
+TOPIC_KEYS = tuple(TOPIC_MAP)
 
 st.set_page_config(
     page_title="EquiGrader AI", 
@@ -13,63 +26,157 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom Styling
-st.markdown("""
-    <style>
-    .stApp {
-        background: linear-gradient(to bottom right, #0f2027, #203a43, #2c5364);
-        color: white;
-    }
-    .card {
-        background: rgba(255, 255, 255, 0.1);
-        backdrop-filter: blur(10px);
-        border-radius: 15px;
-        padding: 2rem;
-        border: 1px solid rgba(255, 255, 255, 0.2);
-        text-align: center;
-        margin-bottom: 20px;
-    }
-    .header-text {
-        font-weight: 800;
-        font-size: 3rem;
-        background: -webkit-linear-gradient(45deg, #00f2fe, #4facfe);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-    }
-    div.stButton > button:first-child {
-        background: linear-gradient(45deg, #4facfe, #00f2fe);
-        color: white;
-        border-radius: 50px;
-        font-weight: bold;
-        width: 100%;
-        height: 3em;
-    }
-    #MainMenu, footer, header {visibility: hidden;}
-    </style>
-""", unsafe_allow_html=True)
+# Custom Styling (read from disk once per process; Streamlit drops elements
+# that aren't re-emitted, so the <style> tag itself is written every rerun)
+@st.cache_resource
+def load_css():
+    with open(os.path.join(os.path.dirname(__file__), "style.css")) as f:
+        return f"<style>{f.read()}</style>"
+
+st.markdown(load_css(), unsafe_allow_html=True)
 
 # Init session
 if 'question_data' not in st.session_state:
     st.session_state.question_data = None
+if 'topic' not in st.session_state:
+    st.session_state.topic = None
+if 'question_queue' not in st.session_state:
+    st.session_state.question_queue = []
 
 # Helpers
-def check_backend():
+@st.cache_resource
+def get_session():
+    # One keep-alive session for every backend call, kept across reruns.
+    # Connection errors / timeouts / 5xx (e.g. backend still starting) are
+    # retried in the adapter with exponential backoff + jitter, capped at 30s.
+    # 4xx responses are not retried. Read timeouts and 5xx are only retried
+    # for idempotent methods (urllib3's default), so a slow /evaluate_answer
+    # POST is never re-sent while the first grading is still running.
+    session = requests.Session()
+    retry = Retry(
+        total=5,
+        connect=5,
+        read=3,
+        backoff_factor=0.3,
+        backoff_jitter=0.5,
+        backoff_max=30,
+        status_forcelist=(502, 503, 504),
+    )
+    session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry))
+    # The health probe should report "offline" right away, not back off
+    session.mount(f"{API_URL}/health", HTTPAdapter(max_retries=0))
+    return session
+
+@st.cache_data(ttl=30, show_spinner=False)
+def backend_online():
+    # At most one ping per 30s; a warm keep-alive connection answers in well under 0.5s
     try:
-        requests.get(f"{API_URL}/docs", timeout=1)
-        return True
-    except:
+        return get_session().get(f"{API_URL}/health", timeout=0.5).status_code == 200
+    except requests.RequestException:
         return False
 
-def fetch_question(topic):
-    # Retry logic if backend is sleeping
-    for _ in range(5):
+def fetch_question(topic, endpoint="get_question"):
+    try:
+        r = get_session().get(f"{API_URL}/{endpoint}", params={"topic": topic}, timeout=(1.0, 5.0))
+        r.raise_for_status()
+        return r.json()
+    except requests.RequestException:
+        # Backend unreachable even after the adapter's backoff retries, or an
+        # error status (404 when the topic has no questions, 5xx)
+        return None
+
+@st.cache_data(ttl=600, show_spinner=False)
+def prefetch_questions(topic, n=20):
+    # Pool of distinct questions per topic, shared across reruns and users.
+    # Errors propagate so a failed fetch is not cached.
+    session = get_session()
+    r = session.get(f"{API_URL}/get_questions", params={"topic": topic, "n": n}, timeout=5)
+    if r.status_code != 404:
+        r.raise_for_status()
+        return r.json()
+
+    # Older backend without /get_questions: one request per question
+    pool = {}
+    for _ in range(n):
+        r = session.get(f"{API_URL}/get_question", params={"topic": topic}, timeout=3)
+        r.raise_for_status()
+        q = r.json()
+        pool[q["id"]] = q
+    return list(pool.values())
+
+def next_question(topic):
+    # Serve from this session's shuffled queue, refilling it from the cached pool
+    if not st.session_state.question_queue:
+        try:
+            pool = prefetch_questions(topic)
+        except requests.RequestException:
+            return None
+        # Skip the question that's on screen right now
+        current = st.session_state.question_data
+        current_id = current["id"] if current else None
+        candidates = [q for q in pool if q["id"] != current_id]
+        if not candidates:
+            return None
+        st.session_state.question_queue = random.sample(candidates, len(candidates))
+    return st.session_state.question_queue.pop()
+
+@st.cache_resource
+def get_executor():
+    # Worker threads for the long grading requests. Shared by every session,
+    # and a worker stays busy until its request finishes or times out (even if
+    # the user moved on), so leave room for several users at once. The backend
+    # still limits how many gradings actually run in parallel.
+    return ThreadPoolExecutor(max_workers=32)
+
+def wait_for(fut, label="AI is evaluating...", events=None, on_event=None):
+    # Polls a background request instead of blocking on it, so the page keeps
+    # repainting and a click elsewhere can interrupt the wait. If the worker
+    # pushes partial results onto `events`, they're handed to `on_event` as
+    # they arrive.
+    bar = st.progress(0.0, text=label)
+    start = time.monotonic()
+    while not fut.done():
+        elapsed = time.monotonic() - start
+        # Grading usually takes a few seconds; creep toward 95% until it's done
+        bar.progress(min(0.95, elapsed / 20), text=f"{label} ({elapsed:.0f}s)")
+        _drain(events, on_event)
+        time.sleep(0.05)
+    bar.empty()
+    _drain(events, on_event)
+    return fut.result()
+
+def _drain(events, on_event):
+    if events is None:
+        return
+    while True:
         try:
-            r = requests.get(f"{API_URL}/get_question", params={"topic": topic}, timeout=3)
-            if r.status_code == 200:
-                return r.json()
-        except:
-            time.sleep(0.2)
-    return None
+            on_event(events.get_nowait())
+        except queue.Empty:
+            return
+
+def stream_events(session, url, events, **kwargs):
+    # Runs in a worker thread: POSTs with a streamed response and pushes each
+    # NDJSON line onto `events`. An {"error"} line raises ValueError.
+    r = session.post(url, stream=True, **kwargs)
+    try:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if "error" in event:
+                raise ValueError(event["error"])
+            events.put(event)
+    finally:
+        r.close()
+
+def evaluate_answer(payload):
+    # Grades the answer in a worker thread. "Next Question" is served from
+    # the cached question pool, so nothing else needs fetching here.
+    fut = get_executor().submit(
+        get_session().post, f"{API_URL}/evaluate_answer", json=payload, timeout=GRADING_TIMEOUT
+    )
+    return wait_for(fut)
 
 # --- Layout ---
 
@@ -80,7 +187,7 @@ with c1:
     st.caption("Fair & Explainable Technical Interview Assessment")
 
 with c2:
-    if check_backend():
+    if backend_online():
         st.success("⚡ System Online")
     else:
         st.error("💤 Backend Offline")
@@ -111,15 +218,20 @@ if not st.session_state.question_data:
         """)
         # --------------------------------
         
-        topics = {"Electronics (ECE)": "ECE", "Aptitude": "Aptitude"}
-        choice = st.selectbox("Choose Topic:", list(topics.keys()))
-        
-        if st.button("🚀 Start Interview"):
+        # In a form, changing the topic doesn't rerun the script; only Start does
+        with st.form("start_form"):
+            choice = st.selectbox("Choose Topic:", TOPIC_KEYS)
+            submitted = st.form_submit_button("🚀 Start Interview")
+
+        if submitted:
             with st.spinner("Connecting..."):
-                topic_code = topics[choice]
-                q = fetch_question(topic_code)
+                topic_code = TOPIC_MAP[choice]
+                # Also warms up the grader model on the backend
+                q = fetch_question(topic_code, endpoint="start_interview")
                 if q:
                     st.session_state.question_data = q
+                    st.session_state.topic = topic_code
+                    st.session_state.question_queue = []
                     st.rerun()
                 else:
                     st.error("Could not fetch question. Is backend running?")
@@ -140,22 +252,21 @@ else:
                 if not txt_ans:
                     st.warning("Please type something.")
                 else:
-                    # UPDATED: Changed spinner text here
-                    with st.spinner("AI is evaluating..."):
-                        try:
-                            payload = {"question_id": q['id'], "answer_text": txt_ans}
-                            res = requests.post(f"{API_URL}/evaluate_answer", json=payload)
-                            if res.status_code == 200:
-                                data = res.json()
-                                st.divider()
-                                
-                                sc_col, fb_col = st.columns([1, 3])
-                                sc_col.metric("Score", f"{data['overall_score']}%")
-                                fb_col.info(f"**Feedback:** {data['final_summary']}")
-                            else:
-                                st.error("Grading failed.")
-                        except Exception as e:
-                            st.error(f"Error: {e}")
+                    try:
+                        payload = {"question_id": q['id'], "answer_text": txt_ans}
+                        res = evaluate_answer(payload)
+                        res.raise_for_status()
+                        data = res.json()
+                    except (requests.HTTPError, ValueError):
+                        st.error("Grading failed.")
+                    except requests.RequestException as e:
+                        st.error(f"Error: {e}")
+                    else:
+                        st.divider()
+                        
+                        sc_col, fb_col = st.columns([1, 3])
+                        sc_col.metric("Score", f"{data['overall_score']}%")
+                        fb_col.info(f"**Feedback:** {data['final_summary']}")
 
     # Audio Tab
     with t2:
@@ -170,29 +281,46 @@ else:
         if audio:
             st.audio(audio['bytes'])
             if st.button("Analyze Recording"):
-                # UPDATED: Changed spinner text here too
-                with st.spinner("AI is evaluating..."):
-                    try:
-                        files = {
-                            "audio_file": ("rec.wav", audio['bytes'], "audio/wav"),
-                            "question_id": (None, q['id'])
-                        }
-                        r = requests.post(f"{API_URL}/evaluate_audio", files=files)
-                        if r.status_code == 200:
-                            data = r.json()
-                            st.success(f"Score: {data['overall_score']}%")
-                            st.caption(f"Transcript: {data.get('transcribed_text')}")
-                            st.write(data['final_summary'])
-                        else:
-                            st.error("Audio processing failed.")
-                    except Exception as e:
-                        st.error(f"Conn Error: {e}")
+                try:
+                    # Pass a file object (not a bytes copy)
+                    files = {
+                        "audio_file": ("rec.wav", io.BytesIO(audio['bytes']), "audio/wav"),
+                        "question_id": (None, q['id'])
+                    }
+                    # The backend streams NDJSON: the transcript as soon as
+                    # Whisper is done, then the graded result. The worker reads
+                    # the stream; this thread keeps polling and repainting.
+                    events = queue.Queue()
+                    transcript = st.empty()
+                    data = {}
+
+                    def show_event(event):
+                        if "result" in event:
+                            data.update(event["result"])
+                        elif "delta" in event:
+                            transcript.caption(f"Transcript: {event['delta']}")
+
+                    fut = get_executor().submit(
+                        stream_events, get_session(), f"{API_URL}/evaluate_audio_stream",
+                        events, files=files, timeout=120
+                    )
+                    wait_for(fut, events=events, on_event=show_event)
+                except (requests.HTTPError, ValueError):
+                    st.error("Audio processing failed.")
+                except requests.RequestException as e:
+                    st.error(f"Conn Error: {e}")
+                else:
+                    if data:
+                        st.success(f"Score: {data['overall_score']}%")
+                        st.write(data['final_summary'])
+                    else:
+                        st.error("Audio processing failed.")
 
     # Next Question
     st.markdown("<br>", unsafe_allow_html=True)
     if st.button("⏭️ Next Question"):
         with st.spinner("Loading..."):
-            new_q = fetch_question("ECE") 
+            new_q = next_question(st.session_state.topic or "ECE")
             if new_q:
                 st.session_state.question_data = new_q
                 st.rerun()